@@ -4,6 +4,7 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 from glob import glob
+from os import getenv
 from os.path import basename
 from os.path import splitext
 
@@ -14,6 +15,15 @@ from setuptools import setup
 with open("README.md", "r") as fh:
     long_description = fh.read()
 
+# Optionally compile the flip analysis with mypyc, this requires mypy to be installed.
+if getenv("EVGFLIP_USE_MYPYC", "0") == "1":
+    from mypyc.build import mypycify
+    ext_modules = mypycify([
+        "src/evgflip/find_flips.py",
+    ])
+else:
+    ext_modules = []
+
 setup(
     name='evgflip',
     version='0.1.0',
@@ -27,6 +37,7 @@ setup(
     packages=find_packages('src'),
     package_dir={'': 'src'},
     py_modules=[splitext(basename(path))[0] for path in glob('src/*.py')],
+    ext_modules=ext_modules,
     include_package_data=True,
     zip_safe=False,
     classifiers=[
@@ -40,12 +51,15 @@ setup(
         'Programming Language :: Python :: Implementation :: PyPy',
     ],
     install_requires=[
-        'boltons==19.1.0',
         'Click==7.0',
         'evergreen.py==0.5.0',
         'PyYAML==5.4',
+        'requests==2.22.0',
         'structlog==19.1.0',
     ],
+    extras_require={
+        'orjson': ['orjson==3.8.3'],
+    },
     entry_points='''
         [console_scripts]
         evg-flip=evgflip.cli:main
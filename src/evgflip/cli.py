@@ -42,12 +42,19 @@ def cli(ctx, verbose):
 @click.option("--days-back", type=int, required=True, help="How far back to analyze.")
 @click.option("--n-threads", type=int, default=DEFAULT_THREADS,
               help="Number of threads to execute with.")
-def find_flips(ctx, project, days_back, n_threads):
+@click.option("--auto-threads", is_flag=True, default=False,
+              help="Pick the number of threads based on the latency of evergreen, "
+                   "overrides --n-threads.")
+@click.option("--cache-file", type=click.Path(dir_okay=False), default=None,
+              help="File to cache the tasks of completed versions in between runs.")
+def find_flips(ctx, project, days_back, n_threads, auto_threads, cache_file):
     evg_api = ctx.obj['evg_api']
+    if auto_threads:
+        n_threads = None
     start_date = datetime.combine(datetime.now() - timedelta(days=days_back), time())
 
     LOGGER.debug("calling find_flips", project=project, start_date=start_date, evg_api=evg_api)
-    commits_flipped = find(project, start_date, evg_api, n_threads)
+    commits_flipped = find(project, start_date, evg_api, n_threads, cache_file)
 
     print(json.dumps(commits_flipped, indent=4))
 
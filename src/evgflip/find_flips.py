@@ -1,38 +1,72 @@
-from collections import namedtuple
-from concurrent.futures import ThreadPoolExecutor as Executor
+import json
+import sqlite3
+from collections import deque, OrderedDict
+from concurrent.futures import (as_completed, FIRST_COMPLETED, Future,
+                                ThreadPoolExecutor as Executor, wait)
 from datetime import datetime
-from typing import Dict, List
+from functools import lru_cache
+from itertools import chain
+from math import log2
+from queue import Full, Queue
+from sys import intern
+from threading import Event, Lock, Thread
+from time import get_clock_info, perf_counter, thread_time
+from typing import (Deque, Dict, Generator, Iterable, Iterator, List, NamedTuple, Optional, Set,
+                    Tuple)
+from urllib.parse import urlparse
 
-from boltons.iterutils import windowed_iter
 from evergreen.api import EvergreenApi
 from evergreen.build import Build
 from evergreen.task import Task
 from evergreen.version import Version
+from requests import Response
+from requests.adapters import HTTPAdapter
 from structlog import get_logger
 
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
 LOGGER = get_logger(__name__)
 
 DEFAULT_THREADS = 16
+MIN_AUTO_THREADS = 8
+MAX_AUTO_THREADS = 256
+THREAD_CLOCK_RESOLUTION = get_clock_info("thread_time").resolution
+DEFAULT_CACHE_SIZE = 128
+PREFETCH_POLL_SEC = 0.1
+# Bump when the format of the stored task statuses changes.
+STORE_SCHEMA_VERSION = 1
 
-FlipList = namedtuple("FlipList", [
-    "revision",
-    "flipped_tasks",
-])
+_END_OF_ITEMS = object()
 
-WorkItem = namedtuple("WorkItem", [
-    "version",
-    "version_next",
-    "version_prev",
-])
 
+class FlipList(NamedTuple):
+    """Tasks that flipped in a revision, by build variant."""
+
+    revision: str
+    flipped_tasks: Dict[str, List[str]]
+
+
+class BuildStatuses(NamedTuple):
+    """Statuses of the tasks in a build by display_name."""
+
+    statuses: Dict[str, str]
+    failures: Dict[str, str]
 
-def _filter_empty_values(d: Dict) -> Dict:
-    """
-    Filter any empty items out of the given dictionary.
-    :param d: dictionary to filter.
-    :return: dictionary with empty values filtered out.
-    """
-    return {k: v for k, v in d.items() if v}
+
+class WorkItem(NamedTuple):
+    """A version to analyze along with its neighbouring versions."""
+
+    version: Version
+    version_next: Version
+    version_prev: Version
+    task_cache: "VersionTaskCache"
+
+
+_NO_TASKS = BuildStatuses({}, {})
 
 
 def _filter_builds(build: Build) -> bool:
@@ -47,106 +81,549 @@ def _filter_builds(build: Build) -> bool:
     return False
 
 
-def _create_task_map(tasks: [Task]) -> Dict:
+def _create_build_statuses(tasks: List[Task]) -> BuildStatuses:
     """
-    Create a dictionary of tasks by display_name.
+    Collect the statuses of the given tasks by display_name.
+
+    Names and statuses are interned, they repeat in every version and comparing them between
+    versions can then short-circuit on identity.
 
-    :param tasks: List of tasks to map.
-    :return: Dictionary of tasks by display_name.
+    :param tasks: List of tasks in a build.
+    :return: Statuses of all the tasks and of the activated tasks that did not succeed.
+    """
+    statuses = {}
+    failures = {}
+    for task in tasks:
+        display_name = intern(task.display_name)
+        status = intern(task.status)
+        statuses[display_name] = status
+        if task.activated and not task.is_success():
+            failures[display_name] = status
+    return BuildStatuses(statuses, failures)
+
+
+def _tasks_by_variant(version: Version, executor: Optional[Executor] = None,
+                      builds: Optional[List[Build]] = None) -> Dict[str, BuildStatuses]:
     """
-    return {task.display_name: task for task in tasks}
+    Create a dictionary of task statuses by build variant for the given version.
 
+    Tasks are only fetched for builds that are not filtered.
 
-def _is_task_a_flip(task: Task, next_tasks: Dict, prev_tasks: Dict) -> bool:
+    :param version: Version to get tasks for.
+    :param executor: Thread pool to fetch the tasks of builds in parallel with.
+    :param builds: Builds of the version if they have already been fetched.
+    :return: Dictionary of build variant to task statuses.
     """
-    Determine if given task has flipped to states in this version.
+    if builds is None:
+        builds = version.get_builds()
+    builds = [build for build in builds if _filter_builds(build)]
+    fetch = executor.map if executor else map
+    build_tasks = fetch(lambda build: build.get_tasks(), builds)
+    return {
+        build.build_variant: _create_build_statuses(tasks)
+        for build, tasks in zip(builds, build_tasks)
+    }
+
 
-    :param task: Task to check.
-    :param next_tasks: Dictionary of tasks in next version.
-    :param prev_tasks: Dictionary of tasks in previous version.
-    :return: True if task has flipped in this version.
+class VersionTaskStore(object):
     """
-    if task.activated and not task.is_success():
-        task_prev = next_tasks.get(task.display_name)
-        if not task_prev or task_prev.status != task.status:
-            # this only failed once, don't count it.
-            return False
-        task_next = prev_tasks.get(task.display_name)
-        if not task_next or task_next.status == task.status:
-            # this was already failing, don't count it.
-            return False
-        return True
-    return False
+    Persistent store of the task statuses of completed versions, backed by sqlite.
 
+    The tasks of a completed version no longer change, so they can be reused between runs.
+    """
 
-def _flips_for_build(build: Build, next_version: Version, prev_version: Version) -> List[str]:
+    def __init__(self, path: str, api_server: str):
+        """
+        Open a store of version tasks, creating it if needed.
+
+        :param path: Path to the sqlite file to store tasks in.
+        :param api_server: Evergreen server the versions come from.
+        """
+        self._key_prefix = f"{STORE_SCHEMA_VERSION}:{api_server}:"
+        self._lock = Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS version_tasks (key TEXT PRIMARY KEY, tasks TEXT)")
+
+    def get(self, version_id: str) -> Optional[Dict[str, BuildStatuses]]:
+        """
+        Get the stored task statuses by build variant for a version.
+
+        :param version_id: Id of version to look up.
+        :return: Dictionary of build variant to task statuses, None if the version is not stored.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT tasks FROM version_tasks WHERE key = ?",
+                                   (self._key_prefix + version_id, )).fetchone()
+        if row is None:
+            return None
+
+        return {
+            variant: BuildStatuses(_intern_items(statuses), _intern_items(failures))
+            for variant, (statuses, failures) in json.loads(row[0]).items()
+        }
+
+    def put(self, version_id: str, tasks: Dict[str, BuildStatuses]):
+        """
+        Store the task statuses by build variant for a version.
+
+        :param version_id: Id of version to store.
+        :param tasks: Dictionary of build variant to task statuses.
+        """
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO version_tasks VALUES (?, ?)",
+                             (self._key_prefix + version_id, json.dumps(tasks)))
+
+    def close(self):
+        """Close the underlying database."""
+        with self._lock:
+            self._db.close()
+
+
+def _intern_items(d: Dict[str, str]) -> Dict[str, str]:
     """
-    Build a list of tasks that flipped in this build.
+    Intern the keys and values of the given dictionary.
 
-    :param build: Build to check.
-    :param next_version: Next version to check against.
-    :param prev_version: Previous version to check against.
-    :return: List of tasks that flipped in given build.
+    :param d: Dictionary of strings.
+    :return: Dictionary with the same items, interned.
+    """
+    return {intern(k): intern(v) for k, v in d.items()}
+
+
+class VersionTaskCache(object):
+    """
+    Thread-safe cache of the tasks by build variant for versions.
+
+    Each version is analyzed once and used as the next and previous version of its neighbours, so
+    caching lets its tasks be fetched once instead of three times.
     """
-    next_build = next_version.build_by_variant(build.build_variant)
-    prev_build = prev_version.build_by_variant(build.build_variant)
 
-    tasks = build.get_tasks()
-    next_tasks = _create_task_map(next_build.get_tasks())
-    prev_tasks = _create_task_map(prev_build.get_tasks())
+    def __init__(self, max_size: int = DEFAULT_CACHE_SIZE, executor: Optional[Executor] = None,
+                 store: Optional[VersionTaskStore] = None,
+                 builds: Optional[Dict[str, List[Build]]] = None):
+        """
+        Create a cache of version tasks.
+
+        :param max_size: Maximum number of versions to keep in the cache.
+        :param executor: Thread pool to fetch the tasks of builds in parallel with.
+        :param store: Persistent store to check before fetching and to save completed versions to.
+        :param builds: Builds already fetched for some versions, by version_id.
+        """
+        self._max_size = max_size
+        self._executor = executor
+        self._store = store
+        self._builds = dict(builds) if builds else {}
+        self._lock = Lock()
+        self._cache: "OrderedDict[str, Future]" = OrderedDict()
+
+    def get(self, version: Version) -> Dict[str, BuildStatuses]:
+        """
+        Get the task statuses by build variant for the given version.
+
+        If another thread is already fetching the version, wait for its result instead of
+        fetching it again.
+
+        :param version: Version to get tasks for.
+        :return: Dictionary of build variant to task statuses.
+        """
+        key = version.version_id
+        with self._lock:
+            future = self._cache.get(key)
+            if future is None:
+                is_owner = True
+                future = Future()
+                self._cache[key] = future
+                if len(self._cache) > self._max_size:
+                    self._cache.popitem(last=False)
+            else:
+                is_owner = False
+                self._cache.move_to_end(key)
+
+        if is_owner:
+            try:
+                future.set_result(self._fetch(version))
+            except Exception as err:
+                # Don't cache failures, the next request for this version should try again.
+                with self._lock:
+                    if self._cache.get(key) is future:
+                        del self._cache[key]
+                future.set_exception(err)
+
+        return future.result()
+
+    def _fetch(self, version: Version) -> Dict[str, BuildStatuses]:
+        """
+        Get the task statuses of a version from the store or from evergreen.
+
+        :param version: Version to get tasks for.
+        :return: Dictionary of build variant to task statuses.
+        """
+        builds = self._builds.pop(version.version_id, None)
+        if self._store:
+            tasks = self._store.get(version.version_id)
+            if tasks is not None:
+                return tasks
+
+        tasks = _tasks_by_variant(version, self._executor, builds)
+        if self._store and version.is_completed():
+            self._store.put(version.version_id, tasks)
+        return tasks
+
+
+def _flips_for_build(build: BuildStatuses, next_build: BuildStatuses,
+                     prev_build: BuildStatuses) -> List[str]:
+    """
+    Build a list of tasks that flipped in a build.
+
+    A flip keeps failing in the same way in the next version and was not already failing that way
+    in the previous version.
 
+    :param build: Task statuses in the build to check.
+    :param next_build: Task statuses in the same build variant of the next version.
+    :param prev_build: Task statuses in the same build variant of the previous version.
+    :return: List of tasks that flipped in given build.
+    """
+    next_statuses = next_build.statuses
+    prev_statuses = prev_build.statuses
     return [
-        task.display_name for task in tasks
-        if _is_task_a_flip(task, next_tasks, prev_tasks)
+        display_name for display_name, status in build.failures.items()
+        if next_statuses.get(display_name) == status
+        and prev_statuses.get(display_name, status) != status
     ]
 
 
+def _neighbour_tasks(version: Version, tasks: Dict[str, BuildStatuses],
+                     variant: str) -> BuildStatuses:
+    """
+    Get the task statuses of a build variant in a neighbouring version.
+
+    The cached tasks only cover builds whose display name passes `_filter_builds`. A variant can
+    gain or lose that marker between versions, so fall back to looking the build up directly
+    rather than treating it as missing.
+
+    :param version: Neighbouring version to look in.
+    :param tasks: Cached task statuses of the neighbouring version.
+    :param variant: Build variant to look up.
+    :return: Task statuses of the build variant, empty if the version did not run it.
+    """
+    if variant in tasks:
+        return tasks[variant]
+
+    try:
+        build = version.build_by_variant(variant)
+    except (AttributeError, KeyError):
+        return _NO_TASKS
+    return _create_build_statuses(build.get_tasks())
+
+
 def _flips_for_version(work_item: WorkItem):
     """
     Build a dictionary of tasks that flipped for builds in this version.
 
+    Tasks for each of the versions are looked up in the task cache and then compared by build
+    variant.
+
     :param work_item: Container of work items to analyze.
     :return: FlipList of what tasks flipped.
     """
     version = work_item.version
-    prev_version = work_item.version_prev
-    next_version = work_item.version_next
+    task_cache = work_item.task_cache
+    tasks = task_cache.get(version)
+    if not tasks:
+        # No builds to check, so there is no need to look at the other versions.
+        return FlipList(version.revision, {})
 
-    builds = [build for build in version.get_builds() if _filter_builds(build)]
-    flipped_tasks = {
-        b.build_variant: _flips_for_build(b, next_version, prev_version)
-        for b in builds
-    }
+    version_next = work_item.version_next
+    version_prev = work_item.version_prev
+    next_tasks = task_cache.get(version_next)
+    prev_tasks = task_cache.get(version_prev)
+
+    flipped_tasks = {}
+    for variant, build in tasks.items():
+        flips = _flips_for_build(build, _neighbour_tasks(version_next, next_tasks, variant),
+                                 _neighbour_tasks(version_prev, prev_tasks, variant))
+        if flips:
+            flipped_tasks[variant] = flips
+
+    return FlipList(version.revision, flipped_tasks)
+
+
+@lru_cache(maxsize=None)
+def _get_executor(n_threads: int, name: str = "evgflip") -> Executor:
+    """
+    Get a long-lived thread pool with the given number of threads.
+
+    Pools are shared between calls to find so threads are not started for every call.
+
+    :param n_threads: Number of threads in the pool.
+    :param name: Name of the pool, used as the prefix of its thread names.
+    :return: Thread pool to submit work to.
+    """
+    return Executor(max_workers=n_threads, thread_name_prefix=name)
+
+
+def _add_flips(flips: Dict[str, Dict[str, List[str]]], flip_list: FlipList):
+    """
+    Add the flipped tasks of a revision to the flips found so far.
+
+    :param flips: Dictionary of revision to flipped tasks to add to.
+    :param flip_list: Flipped tasks in a revision.
+    """
+    if flip_list.flipped_tasks:
+        flips[flip_list.revision] = flip_list.flipped_tasks
+
+
+def _thread_bucket(concurrency: float) -> int:
+    """
+    Round the given concurrency to a power of two between the auto thread limits.
+
+    Thread pools are kept alive per size, so rounding keeps the number of pools that noisy
+    measurements can create small.
+
+    :param concurrency: Desired number of threads.
+    :return: Number of threads to use.
+    """
+    if concurrency < MIN_AUTO_THREADS:
+        return MIN_AUTO_THREADS
+    return min(2 ** round(log2(concurrency)), MAX_AUTO_THREADS)
+
+
+def _threads_for_probe(duration: float, cpu_time: float) -> int:
+    """
+    Pick a number of threads from the wall and CPU time a probe request took.
+
+    Thread clocks can be coarse (around 15 ms on Windows), so a fast request may measure no CPU
+    time at all. There is nothing to base a ratio on then, so the default is used.
+
+    :param duration: Wall time the request took.
+    :param cpu_time: CPU time spent on the request.
+    :return: Number of threads to use.
+    """
+    if cpu_time <= THREAD_CLOCK_RESOLUTION:
+        return DEFAULT_THREADS
+    return _thread_bucket(duration / cpu_time)
+
+
+def _auto_threads(
+        versions: Iterator[Version]) -> Tuple[int, Iterator[Version], Dict[str, List[Build]]]:
+    """
+    Pick a number of threads based on how long evergreen takes to respond.
+
+    A request spends most of its time waiting on the network, so enough threads are used to keep
+    a core busy while the rest wait: the time a request took divided by the CPU time spent on it.
+    The first page of versions opens the connection, then listing the builds of the first version
+    is timed as the probe. Those builds are returned so they don't need to be fetched again.
+
+    :param versions: Iterator of versions that has not been started.
+    :return: Number of threads to use, an iterator over the same versions and the builds fetched
+        by version_id.
+    """
+    first_version = next(versions, None)
+    if first_version is None:
+        return MIN_AUTO_THREADS, versions, {}
+
+    start_time = perf_counter()
+    start_cpu_time = thread_time()
+    builds = first_version.get_builds()
+    duration = perf_counter() - start_time
+    cpu_time = thread_time() - start_cpu_time
+
+    n_threads = _threads_for_probe(duration, cpu_time)
+    LOGGER.info("Picked number of threads", n_threads=n_threads, duration=duration,
+                cpu_time=cpu_time)
+
+    return n_threads, chain([first_version], versions), {first_version.version_id: builds}
+
+
+def _parse_json_with_orjson(response: Response, *args, **kwargs) -> Response:
+    """
+    Response hook to parse the JSON body of a response with orjson instead of the json module.
 
-    return FlipList(version.revision, _filter_empty_values(flipped_tasks))
+    :param response: Response from the Evergreen API.
+    :return: The same response, with json() parsing its content with orjson.
+    """
+    response.json = lambda **json_kwargs: orjson.loads(response.content)  # type: ignore
+    return response
+
+
+def _configure_session(evg_api: EvergreenApi, n_threads: int):
+    """
+    Tune the Evergreen API session for the threads that will share it.
+
+    requests keeps 10 connections per host by default. Any thread beyond that has its connection
+    discarded after each request and pays for a new TCP and TLS handshake on the next one. If the
+    adapter for the scheme of the API server is too small, it is replaced with a larger one that
+    keeps its retry settings.
+
+    If orjson is installed, it is used to parse responses. It is several times faster than the
+    json module for the large task listings.
+
+    :param evg_api: Evergreen API to configure.
+    :param n_threads: Number of threads in each of the version and build pools.
+    """
+    # Version workers, build workers and the version prefetch thread all make requests.
+    pool_size = n_threads * 2 + 1
+    prefix = f"{urlparse(evg_api._api_server).scheme}://"
+    adapter = evg_api.session.adapters.get(prefix)
+    # Leave adapters that are large enough, or that we don't know how to resize, alone.
+    if isinstance(adapter, HTTPAdapter) and adapter._pool_maxsize < pool_size:
+        evg_api.session.mount(
+            prefix, HTTPAdapter(pool_maxsize=pool_size, max_retries=adapter.max_retries))
+        adapter.close()
+
+    response_hooks = evg_api.session.hooks["response"]
+    if HAS_ORJSON and _parse_json_with_orjson not in response_hooks:
+        response_hooks.append(_parse_json_with_orjson)
+
+
+def _prefetch(items: Iterable, buffer_size: int) -> Generator:
+    """
+    Iterate over the given items in a background thread.
+
+    Up to buffer_size items are fetched ahead of the consumer, so any I/O done by the iterable
+    overlaps with the processing of items already returned.
+
+    :param items: Iterable to prefetch from.
+    :param buffer_size: Maximum number of items to fetch ahead.
+    :return: Iterator over the same items.
+    """
+    buffer: Queue = Queue(maxsize=buffer_size)
+    stop = Event()
+
+    def put(entry) -> bool:
+        # Wake up periodically so an abandoned consumer doesn't leave this thread blocked forever.
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout=PREFETCH_POLL_SEC)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+        except Exception as err:
+            put((_END_OF_ITEMS, err))
+            return
+        put((_END_OF_ITEMS, None))
+
+    Thread(target=produce, name="evgflip-prefetch", daemon=True).start()
+    try:
+        while True:
+            item, err = buffer.get()
+            if item is _END_OF_ITEMS:
+                if err:
+                    raise err
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def _work_items(versions: Iterable[Version], look_back: datetime,
+                task_cache: VersionTaskCache) -> Iterator[WorkItem]:
+    """
+    Create work items for each version created after the look back date.
+
+    :param versions: Versions to analyze, newest first.
+    :param look_back: Stop at versions created before this date.
+    :param task_cache: Cache of version tasks to share between work items.
+    :return: Iterator of work items.
+    """
+    window: Deque[Version] = deque(maxlen=3)
+    for newest_version in versions:
+        window.append(newest_version)
+        if len(window) < 3:
+            continue
+        next_version, version, prev_version = window
+
+        log = LOGGER.bind(version=version.version_id)
+        log.debug("Starting to look")
+        if version.create_time < look_back:
+            log.debug("done", create_time=version.create_time)
+            return
+
+        yield WorkItem(version, next_version, prev_version, task_cache)
+        if prev_version.create_time < look_back:
+            # Nothing older will be analyzed, so don't page in another version to find that out.
+            log.debug("done", create_time=prev_version.create_time)
+            return
 
 
 def find(project: str, look_back: datetime, evg_api: EvergreenApi,
-         n_threads: int = DEFAULT_THREADS) -> Dict:
+         n_threads: Optional[int] = DEFAULT_THREADS, cache_file: Optional[str] = None) -> Dict:
     """
     Find test flips in the evergreen project.
 
     :param project: Evergreen project to analyze.
     :param look_back: Look at commits until the given project.
     :param evg_api: Evergreen API.
-    :param n_threads: Number of threads to use.
+    :param n_threads: Number of threads to use, None to pick based on the latency of evergreen.
+    :param cache_file: File to keep the tasks of completed versions in between runs.
     :return: Dictionary of commits that introduced task flips.
     """
-    LOGGER.debug("Starting find_flips iteration")
-    version_iterator = evg_api.versions_by_project(project)
+    store = VersionTaskStore(cache_file, evg_api._api_server) if cache_file else None
+    try:
+        return _find(project, look_back, evg_api, n_threads, store)
+    finally:
+        if store:
+            store.close()
 
-    with Executor(max_workers=n_threads) as exe:
-        jobs = []
-        for next_version, version, prev_version in windowed_iter(version_iterator, 3):
-            log = LOGGER.bind(version=version.version_id)
-            log.debug("Starting to look")
-            if version.create_time < look_back:
-                log.debug("done", create_time=version.create_time)
-                break
 
-            work_item = WorkItem(version, next_version, prev_version)
-            jobs.append(exe.submit(_flips_for_version, work_item))
-
-        results = [job.result() for job in jobs]
+def _find(project: str, look_back: datetime, evg_api: EvergreenApi, n_threads: Optional[int],
+          store: Optional[VersionTaskStore]) -> Dict:
+    """
+    Find test flips in the evergreen project.
 
-    return {r.revision: r.flipped_tasks for r in results if r.flipped_tasks}
+    :param project: Evergreen project to analyze.
+    :param look_back: Look at commits until the given project.
+    :param evg_api: Evergreen API.
+    :param n_threads: Number of threads to use, None to pick based on the latency of evergreen.
+    :param store: Persistent store of version tasks.
+    :return: Dictionary of commits that introduced task flips.
+    """
+    LOGGER.debug("Starting find_flips iteration")
+    versions = iter(evg_api.versions_by_project(project))
+    builds: Dict[str, List[Build]] = {}
+    if n_threads is None:
+        n_threads, versions, builds = _auto_threads(versions)
+
+    _configure_session(evg_api, n_threads)
+    max_pending = n_threads * 2
+    # Version workers wait on build fetches, so builds need their own pool to avoid a deadlock.
+    build_exe = _get_executor(n_threads, "evgflip-build")
+    # Every version in flight and its neighbours should fit in the cache.
+    task_cache = VersionTaskCache(max(DEFAULT_CACHE_SIZE, max_pending + 2), build_exe, store,
+                                  builds)
+    # Page through versions in the background so pagination overlaps with analysis.
+    work_items = _prefetch(
+        _work_items(versions, look_back, task_cache), max_pending)
+
+    exe = _get_executor(n_threads)
+    jobs: Set[Future] = set()
+    flips: Dict[str, Dict[str, List[str]]] = {}
+    try:
+        for work_item in work_items:
+            if len(jobs) >= max_pending:
+                # Keep the window full: collect whatever has finished before submitting more.
+                done, jobs = wait(jobs, return_when=FIRST_COMPLETED)
+                for job in done:
+                    _add_flips(flips, job.result())
+
+            jobs.add(exe.submit(_flips_for_version, work_item))
+
+        for job in as_completed(jobs):
+            _add_flips(flips, job.result())
+    finally:
+        # Stop the prefetch thread right away if a job failed.
+        work_items.close()
+        # Don't leave jobs running against a store that is about to be closed.
+        for job in jobs:
+            job.cancel()
+        wait(jobs)
+
+    return flips
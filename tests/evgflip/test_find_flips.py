@@ -1,97 +1,660 @@
+import threading
+import time
+from datetime import datetime
+from json import JSONDecodeError
 from unittest.mock import MagicMock
 
+import pytest
+import requests
+
 import evgflip.find_flips as under_test
 
 
-class TestFilterEmptyValues:
-    def test_empty_dictionary(self):
-        filtered_dict = under_test._filter_empty_values({})
-        assert {} == filtered_dict
+def build_mock_task(display_name, status):
+    mock_task = MagicMock(display_name=display_name, status=status, activated=True)
+    mock_task.is_success.return_value = status == "success"
+    return mock_task
+
+
+def build_mock_version(revision, create_time, task_statuses, variant="!variant",
+                       display_name=None):
+    mock_build = MagicMock(display_name=display_name or variant, build_variant=variant)
+    mock_build.get_tasks.return_value = [
+        build_mock_task(name, status) for name, status in task_statuses.items()
+    ]
+    mock_version = MagicMock(revision=revision, version_id=f"version_{revision}",
+                             create_time=create_time)
+    mock_version.get_builds.return_value = [mock_build]
+    mock_version.build_by_variant.side_effect = {variant: mock_build}.__getitem__
+    return mock_version
+
+
+def build_mock_evg_api():
+    return MagicMock(_api_server="https://evergreen.mongodb.com", session=requests.Session())
 
-    def test_with_values_no_empty_items(self):
-        test_dict = {
-            "key1": {},
-            "key2": "something",
-            "key3": [],
-            "key4": {"another things"}
-        }
-        filtered_dict = under_test._filter_empty_values(test_dict)
 
-        assert "key1" not in filtered_dict
-        assert "key3" not in filtered_dict
-        assert "key2" in filtered_dict
-        assert "key4" in filtered_dict
+def build_statuses(statuses):
+    failures = {name: status for name, status in statuses.items() if status != "success"}
+    return under_test.BuildStatuses(statuses, failures)
 
 
-class TestCreateTaskMap:
+def assert_prefetch_thread_exits():
+    for thread in threading.enumerate():
+        if thread.name == "evgflip-prefetch":
+            thread.join(timeout=2)
+            assert not thread.is_alive()
+
+
+class TestCreateBuildStatuses:
     def test_empty_list(self):
-        task_map = under_test._create_task_map([])
-        assert {} == task_map
+        build = under_test._create_build_statuses([])
+
+        assert build.statuses == {}
+        assert build.failures == {}
 
     def test_list_of_tasks(self):
-        mock_task_list = [MagicMock(display_name=f"task {i}") for i in range(5)]
-        task_map = under_test._create_task_map(mock_task_list)
+        mock_task_list = [build_mock_task(f"task {i}", "success") for i in range(5)]
+        build = under_test._create_build_statuses(mock_task_list)
 
-        assert task_map["task 0"] == mock_task_list[0]
-        assert len(task_map) == len(mock_task_list)
+        assert build.statuses["task 0"] == "success"
+        assert len(build.statuses) == len(mock_task_list)
+        assert build.failures == {}
 
+    def test_activated_failures(self):
+        mock_task_list = [build_mock_task("failed", "failed"), build_mock_task("passed", "success")]
+        build = under_test._create_build_statuses(mock_task_list)
 
-class TestIsTaskAFlip:
-    def test_non_activated_task_is_not_a_flip(self):
-        mock_task = MagicMock(activated=False)
+        assert build.failures == {"failed": "failed"}
 
-        assert not under_test._is_task_a_flip(mock_task, {}, {})
+    def test_names_and_statuses_are_interned(self):
+        # Build the strings at runtime so they are distinct objects before interning.
+        task_a = build_mock_task("".join(["ta", "sk"]), "".join(["fai", "led"]))
+        task_b = build_mock_task("".join(["tas", "k"]), "".join(["fail", "ed"]))
+        assert task_a.display_name is not task_b.display_name
 
-    def test_successful_task_is_not_a_flip(self):
-        mock_task = MagicMock(activate=True)
-        mock_task.is_success.return_value = True
+        build_a = under_test._create_build_statuses([task_a])
+        build_b = under_test._create_build_statuses([task_b])
 
-        assert not under_test._is_task_a_flip(mock_task, {}, {})
+        (name_a, status_a), = build_a.statuses.items()
+        (name_b, status_b), = build_b.statuses.items()
+        assert name_a is name_b
+        assert status_a is status_b
 
-    def test_no_previous_task_is_not_a_flip(self):
-        mock_task = MagicMock(activate=True)
-        mock_task.is_success.return_value = False
+    def test_non_activated_task_is_not_a_failure(self):
+        mock_task = build_mock_task("task", "failed")
+        mock_task.activated = False
+        build = under_test._create_build_statuses([mock_task])
+
+        assert build.statuses == {"task": "failed"}
+        assert build.failures == {}
+
+
+class TestTasksByVariant:
+    def test_tasks_are_mapped_by_variant(self):
+        mock_builds = [
+            MagicMock(display_name="! variant 0", build_variant="variant_0"),
+            MagicMock(display_name="! variant 1", build_variant="variant_1"),
+        ]
+        for i, mock_build in enumerate(mock_builds):
+            mock_build.get_tasks.return_value = [build_mock_task(f"task {i}", "success")]
+        mock_version = MagicMock()
+        mock_version.get_builds.return_value = mock_builds
+
+        tasks = under_test._tasks_by_variant(mock_version)
+
+        assert len(tasks) == 2
+        assert "task 0" in tasks["variant_0"].statuses
+        assert "task 1" in tasks["variant_1"].statuses
+
+    def test_tasks_are_fetched_with_executor(self):
+        mock_builds = [
+            MagicMock(display_name=f"! variant {i}", build_variant=f"variant_{i}")
+            for i in range(5)
+        ]
+        for i, mock_build in enumerate(mock_builds):
+            mock_build.get_tasks.return_value = [build_mock_task(f"task {i}", "success")]
+        mock_version = MagicMock()
+        mock_version.get_builds.return_value = mock_builds
+
+        tasks = under_test._tasks_by_variant(mock_version, under_test._get_executor(2))
+
+        assert len(tasks) == 5
+        for i in range(5):
+            assert f"task {i}" in tasks[f"variant_{i}"].statuses
+
+    def test_filtered_builds_do_not_fetch_tasks(self):
+        mock_build = MagicMock(display_name="variant 0", build_variant="variant_0")
+        mock_version = MagicMock()
+        mock_version.get_builds.return_value = [mock_build]
+
+        tasks = under_test._tasks_by_variant(mock_version)
+
+        assert tasks == {}
+        mock_build.get_tasks.assert_not_called()
+
+
+class TestVersionTaskStore:
+    def test_missing_version(self, tmp_path):
+        store = under_test.VersionTaskStore(str(tmp_path / "cache.db"), "https://evergreen")
+
+        assert store.get("version_0") is None
+
+    def test_stored_version_is_returned(self, tmp_path):
+        store = under_test.VersionTaskStore(str(tmp_path / "cache.db"), "https://evergreen")
+        tasks = {"variant": build_statuses({"t1": "failed", "t2": "success"})}
+
+        store.put("version_0", tasks)
+
+        assert store.get("version_0") == tasks
+
+    def test_versions_are_kept_between_stores(self, tmp_path):
+        cache_file = str(tmp_path / "cache.db")
+        tasks = {"variant": build_statuses({"t1": "failed"})}
+        store = under_test.VersionTaskStore(cache_file, "https://evergreen")
+        store.put("version_0", tasks)
+        store.close()
+
+        store = under_test.VersionTaskStore(cache_file, "https://evergreen")
+
+        assert store.get("version_0") == tasks
+
+    def test_versions_are_stored_per_server(self, tmp_path):
+        cache_file = str(tmp_path / "cache.db")
+        store = under_test.VersionTaskStore(cache_file, "https://evergreen")
+        store.put("version_0", {"variant": build_statuses({"t1": "failed"})})
+
+        other_store = under_test.VersionTaskStore(cache_file, "https://other-evergreen")
+
+        assert other_store.get("version_0") is None
+
+
+class TestVersionTaskCache:
+    def test_version_is_only_fetched_once(self):
+        mock_version = build_mock_version("rev0", datetime(2019, 8, 5), {"t1": "failed"})
+        task_cache = under_test.VersionTaskCache()
+
+        first = task_cache.get(mock_version)
+        second = task_cache.get(mock_version)
+
+        assert first is second
+        assert "t1" in first["!variant"].statuses
+        mock_version.get_builds.assert_called_once()
+
+    def test_prefetched_builds_are_used(self):
+        mock_version = build_mock_version("rev0", datetime(2019, 8, 5), {"t1": "failed"})
+        mock_builds = mock_version.get_builds.return_value
+        task_cache = under_test.VersionTaskCache(builds={"version_rev0": mock_builds})
+
+        tasks = task_cache.get(mock_version)
+
+        assert "t1" in tasks["!variant"].statuses
+        mock_version.get_builds.assert_not_called()
 
-        assert not under_test._is_task_a_flip(mock_task, {}, {})
+    def test_oldest_version_is_evicted(self):
+        mock_versions = [
+            build_mock_version(f"rev{i}", datetime(2019, 8, 5), {"t1": "failed"}) for i in range(3)
+        ]
+        task_cache = under_test.VersionTaskCache(max_size=2)
 
-    def test_previous_task_changes_is_not_a_flip(self):
-        mock_task = MagicMock(activate=True, status="failed")
-        mock_task.is_success.return_value = False
+        for mock_version in mock_versions:
+            task_cache.get(mock_version)
+        task_cache.get(mock_versions[0])
 
-        mock_prev_task = MagicMock()
-        tasks_prev = {mock_task.display_name: mock_prev_task}
+        assert mock_versions[0].get_builds.call_count == 2
+        mock_versions[1].get_builds.assert_called_once()
 
-        assert not under_test._is_task_a_flip(mock_task, tasks_prev, {})
+    def test_failures_are_not_cached(self):
+        mock_version = build_mock_version("rev0", datetime(2019, 8, 5), {"t1": "failed"})
+        mock_builds = mock_version.get_builds.return_value
+        mock_version.get_builds.side_effect = [ValueError("Evergreen is down"), mock_builds]
+        task_cache = under_test.VersionTaskCache()
 
-    def test_next_task_does_not_exist(self):
-        mock_task = MagicMock(activate=True, status="failed")
-        mock_task.is_success.return_value = False
+        with pytest.raises(ValueError):
+            task_cache.get(mock_version)
+        tasks = task_cache.get(mock_version)
 
-        mock_prev_task = MagicMock(status=mock_task.status)
-        tasks_prev = {mock_task.display_name: mock_prev_task}
+        assert "t1" in tasks["!variant"].statuses
 
-        assert not under_test._is_task_a_flip(mock_task, tasks_prev, {})
+    def test_stored_version_is_not_fetched(self, tmp_path):
+        mock_version = build_mock_version("rev0", datetime(2019, 8, 5), {"t1": "failed"})
+        store = under_test.VersionTaskStore(str(tmp_path / "cache.db"), "https://evergreen")
+        stored_tasks = {"!variant": build_statuses({"t1": "failed"})}
+        store.put(mock_version.version_id, stored_tasks)
+        task_cache = under_test.VersionTaskCache(store=store)
 
-    def test_next_task_does_not_change_status(self):
-        mock_task = MagicMock(activate=True, status="failed")
-        mock_task.is_success.return_value = False
+        tasks = task_cache.get(mock_version)
 
-        mock_prev_task = MagicMock(status=mock_task.status)
-        tasks_prev = {mock_task.display_name: mock_prev_task}
+        assert tasks == stored_tasks
+        mock_version.get_builds.assert_not_called()
 
-        mock_next_task = MagicMock(status=mock_task.status)
-        tasks_next = {mock_task.display_name: mock_next_task}
+    def test_completed_version_is_stored(self, tmp_path):
+        mock_version = build_mock_version("rev0", datetime(2019, 8, 5), {"t1": "failed"})
+        mock_version.is_completed.return_value = True
+        store = under_test.VersionTaskStore(str(tmp_path / "cache.db"), "https://evergreen")
+        task_cache = under_test.VersionTaskCache(store=store)
 
-        assert not under_test._is_task_a_flip(mock_task, tasks_prev, tasks_next)
+        tasks = task_cache.get(mock_version)
+
+        assert store.get(mock_version.version_id) == tasks
+
+    def test_running_version_is_not_stored(self, tmp_path):
+        mock_version = build_mock_version("rev0", datetime(2019, 8, 5), {"t1": "failed"})
+        mock_version.is_completed.return_value = False
+        store = under_test.VersionTaskStore(str(tmp_path / "cache.db"), "https://evergreen")
+        task_cache = under_test.VersionTaskCache(store=store)
+
+        task_cache.get(mock_version)
+
+        assert store.get(mock_version.version_id) is None
+
+
+class TestFlipsForBuild:
+    def test_only_flipped_tasks_returned(self):
+        build = build_statuses({
+            "flipped": "failed",
+            "still failing": "failed",
+            "passing": "success",
+        })
+        next_build = build_statuses({
+            "flipped": "failed",
+            "still failing": "failed",
+            "passing": "success",
+        })
+        prev_build = build_statuses({
+            "flipped": "success",
+            "still failing": "failed",
+            "passing": "success",
+        })
+
+        assert under_test._flips_for_build(build, next_build, prev_build) == ["flipped"]
+
+    def test_no_next_task_is_not_a_flip(self):
+        build = build_statuses({"task": "failed"})
+        prev_build = build_statuses({"task": "success"})
+
+        assert under_test._flips_for_build(build, build_statuses({}), prev_build) == []
+
+    def test_next_task_changes_is_not_a_flip(self):
+        build = build_statuses({"task": "failed"})
+        next_build = build_statuses({"task": "success"})
+        prev_build = build_statuses({"task": "success"})
+
+        assert under_test._flips_for_build(build, next_build, prev_build) == []
+
+    def test_next_task_fails_differently_is_not_a_flip(self):
+        build = build_statuses({"task": "failed"})
+        next_build = build_statuses({"task": "timed out"})
+        prev_build = build_statuses({"task": "success"})
+
+        assert under_test._flips_for_build(build, next_build, prev_build) == []
+
+    def test_no_previous_task_is_not_a_flip(self):
+        build = build_statuses({"task": "failed"})
+        next_build = build_statuses({"task": "failed"})
+
+        assert under_test._flips_for_build(build, next_build, build_statuses({})) == []
+
+    def test_previous_task_does_not_change_is_not_a_flip(self):
+        build = build_statuses({"task": "failed"})
+        next_build = build_statuses({"task": "failed"})
+        prev_build = build_statuses({"task": "failed"})
+
+        assert under_test._flips_for_build(build, next_build, prev_build) == []
 
     def test_was_a_flip(self):
-        mock_task = MagicMock(activate=True, status="failed")
-        mock_task.is_success.return_value = False
+        build = build_statuses({"task": "failed"})
+        next_build = build_statuses({"task": "failed"})
+        prev_build = build_statuses({"task": "success"})
+
+        assert under_test._flips_for_build(build, next_build, prev_build) == ["task"]
+
+    def test_only_failures_are_checked(self):
+        build = under_test.BuildStatuses({"task": "failed"}, {})
+        next_build = build_statuses({"task": "failed"})
+        prev_build = build_statuses({"task": "success"})
+
+        assert under_test._flips_for_build(build, next_build, prev_build) == []
+
+
+class TestGetExecutor:
+    def test_executor_is_reused(self):
+        assert under_test._get_executor(3) is under_test._get_executor(3)
+
+    def test_executor_per_thread_count(self):
+        assert under_test._get_executor(3) is not under_test._get_executor(4)
+
+    def test_executor_per_name(self):
+        assert under_test._get_executor(3) is not under_test._get_executor(3, "other")
+
+
+class TestFlipsForVersion:
+    def test_variants_without_flips_are_left_out(self):
+        versions = [
+            build_mock_version("rev0", datetime(2019, 8, 5), {"t1": "failed"}),
+            build_mock_version("rev1", datetime(2019, 8, 4), {"t1": "failed"}),
+            build_mock_version("rev2", datetime(2019, 8, 3), {"t1": "failed"}),
+        ]
+        work_item = under_test.WorkItem(versions[1], versions[0], versions[2],
+                                        under_test.VersionTaskCache())
+
+        flip_list = under_test._flips_for_version(work_item)
+
+        assert flip_list.revision == "rev1"
+        assert flip_list.flipped_tasks == {}
+
+    def test_neighbours_not_filtered_by_display_name(self):
+        versions = [
+            build_mock_version("rev0", datetime(2019, 8, 5), {"t1": "failed"},
+                               display_name="variant"),
+            build_mock_version("rev1", datetime(2019, 8, 4), {"t1": "failed"}),
+            build_mock_version("rev2", datetime(2019, 8, 3), {"t1": "success"},
+                               display_name="variant"),
+        ]
+        work_item = under_test.WorkItem(versions[1], versions[0], versions[2],
+                                        under_test.VersionTaskCache())
+
+        flip_list = under_test._flips_for_version(work_item)
+
+        assert flip_list.flipped_tasks == {"!variant": ["t1"]}
+
+    def test_variant_missing_from_neighbour(self):
+        versions = [
+            build_mock_version("rev0", datetime(2019, 8, 5), {"t1": "failed"}, variant="!other"),
+            build_mock_version("rev1", datetime(2019, 8, 4), {"t1": "failed"}),
+            build_mock_version("rev2", datetime(2019, 8, 3), {"t1": "success"}),
+        ]
+        work_item = under_test.WorkItem(versions[1], versions[0], versions[2],
+                                        under_test.VersionTaskCache())
+
+        flip_list = under_test._flips_for_version(work_item)
+
+        assert flip_list.flipped_tasks == {}
+
+    def test_version_without_builds_to_check(self):
+        versions = [
+            build_mock_version("rev0", datetime(2019, 8, 5), {"t1": "failed"}),
+            build_mock_version("rev1", datetime(2019, 8, 4), {"t1": "failed"}, variant="variant"),
+            build_mock_version("rev2", datetime(2019, 8, 3), {"t1": "success"}),
+        ]
+        work_item = under_test.WorkItem(versions[1], versions[0], versions[2],
+                                        under_test.VersionTaskCache())
+
+        flip_list = under_test._flips_for_version(work_item)
+
+        assert flip_list.flipped_tasks == {}
+        versions[0].get_builds.assert_not_called()
+        versions[2].get_builds.assert_not_called()
+
+
+class TestThreadBucket:
+    def test_low_concurrency_uses_minimum(self):
+        assert under_test._thread_bucket(0.5) == under_test.MIN_AUTO_THREADS
+
+    def test_high_concurrency_uses_maximum(self):
+        assert under_test._thread_bucket(10000) == under_test.MAX_AUTO_THREADS
+
+    def test_rounded_to_power_of_two(self):
+        assert under_test._thread_bucket(20) == 16
+        assert under_test._thread_bucket(50) == 64
+
+    def test_limited_number_of_sizes(self):
+        sizes = {under_test._thread_bucket(concurrency / 10) for concurrency in range(10000)}
+
+        assert sizes == {8, 16, 32, 64, 128, 256}
+
+
+class TestThreadsForProbe:
+    def test_ratio_of_wall_to_cpu_time(self):
+        assert under_test._threads_for_probe(0.32, 0.01) == 32
+
+    def test_no_cpu_time_measured_uses_default(self):
+        assert under_test._threads_for_probe(0.2, 0.0) == under_test.DEFAULT_THREADS
+
+    def test_cpu_time_below_clock_resolution_uses_default(self):
+        cpu_time = under_test.THREAD_CLOCK_RESOLUTION / 2
+
+        assert under_test._threads_for_probe(0.2, cpu_time) == under_test.DEFAULT_THREADS
+
+
+class TestAutoThreads:
+    def test_slow_responses_use_more_threads(self):
+        mock_version = MagicMock(version_id="version_rev0")
+        mock_version.get_builds.side_effect = lambda: time.sleep(0.1) or []
+        all_versions = [mock_version, MagicMock()]
+
+        n_threads, versions, builds = under_test._auto_threads(iter(all_versions))
+
+        assert under_test.MIN_AUTO_THREADS < n_threads <= under_test.MAX_AUTO_THREADS
+        assert list(versions) == all_versions
+        assert builds == {"version_rev0": []}
+        mock_version.get_builds.assert_called_once()
+
+    def test_no_versions(self):
+        n_threads, versions, builds = under_test._auto_threads(iter([]))
+
+        assert n_threads == under_test.MIN_AUTO_THREADS
+        assert list(versions) == []
+        assert builds == {}
+
+
+class TestAddFlips:
+    def test_revision_with_flips_is_added(self):
+        flips = {}
+
+        under_test._add_flips(flips, under_test.FlipList("rev0", {"variant": ["t1"]}))
+
+        assert flips == {"rev0": {"variant": ["t1"]}}
+
+    def test_revision_without_flips_is_skipped(self):
+        flips = {}
+
+        under_test._add_flips(flips, under_test.FlipList("rev0", {}))
+
+        assert flips == {}
+
+
+class TestConfigureSession:
+    def test_connection_pool_sized_for_threads(self):
+        mock_evg_api = build_mock_evg_api()
+
+        under_test._configure_session(mock_evg_api, 8)
+
+        adapter = mock_evg_api.session.get_adapter("https://evergreen.mongodb.com")
+        assert adapter._pool_maxsize == 17
+
+    def test_other_schemes_are_not_changed(self):
+        mock_evg_api = build_mock_evg_api()
+        http_adapter = mock_evg_api.session.get_adapter("http://evergreen.mongodb.com")
+
+        under_test._configure_session(mock_evg_api, 8)
+
+        assert mock_evg_api.session.get_adapter("http://evergreen.mongodb.com") is http_adapter
+
+    def test_large_enough_adapter_is_kept(self):
+        mock_evg_api = build_mock_evg_api()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=100)
+        mock_evg_api.session.mount("https://", adapter)
+
+        under_test._configure_session(mock_evg_api, 8)
+
+        assert mock_evg_api.session.get_adapter("https://evergreen.mongodb.com") is adapter
+
+    def test_replaced_adapter_is_closed_and_keeps_retries(self):
+        mock_evg_api = build_mock_evg_api()
+        mock_adapter = MagicMock(spec=requests.adapters.HTTPAdapter, _pool_maxsize=10,
+                                 max_retries=3)
+        mock_adapter.close.return_value = None
+        mock_evg_api.session.mount("https://", mock_adapter)
+
+        under_test._configure_session(mock_evg_api, 8)
+
+        adapter = mock_evg_api.session.get_adapter("https://evergreen.mongodb.com")
+        assert adapter is not mock_adapter
+        assert adapter._pool_maxsize == 17
+        assert adapter.max_retries.total == 3
+        mock_adapter.close.assert_called_once()
+
+    def test_orjson_hook_added_once(self):
+        mock_evg_api = build_mock_evg_api()
+
+        under_test._configure_session(mock_evg_api, 8)
+        under_test._configure_session(mock_evg_api, 8)
+
+        hooks = mock_evg_api.session.hooks["response"]
+        assert hooks.count(under_test._parse_json_with_orjson) == int(under_test.HAS_ORJSON)
+
+
+@pytest.mark.skipif(not under_test.HAS_ORJSON, reason="orjson is not installed")
+class TestParseJsonWithOrjson:
+    def test_json_is_parsed(self):
+        response = requests.models.Response()
+        response._content = b'[{"display_name": "task", "status": "failed"}]'
+
+        response = under_test._parse_json_with_orjson(response)
+
+        assert response.json() == [{"display_name": "task", "status": "failed"}]
+
+    def test_invalid_json_raises_decode_error(self):
+        response = requests.models.Response()
+        response._content = b"not json"
+
+        response = under_test._parse_json_with_orjson(response)
+
+        with pytest.raises(JSONDecodeError):
+            response.json()
+
+
+class TestPrefetch:
+    def test_all_items_are_returned_in_order(self):
+        assert list(under_test._prefetch(range(10), 2)) == list(range(10))
+
+    def test_errors_are_raised_to_consumer(self):
+        def failing_items():
+            yield 1
+            raise ValueError("Evergreen is down")
+
+        items = under_test._prefetch(failing_items(), 2)
+
+        assert next(items) == 1
+        with pytest.raises(ValueError):
+            next(items)
+
+    def test_thread_stops_when_consumer_stops(self):
+        items = under_test._prefetch(range(1000), 2)
+
+        assert next(items) == 0
+        items.close()
+
+        assert_prefetch_thread_exits()
+
+
+class TestWorkItems:
+    def test_versions_are_windowed_until_look_back(self):
+        versions = [MagicMock(create_time=datetime(2019, 8, 10 - i)) for i in range(6)]
+        task_cache = under_test.VersionTaskCache()
+
+        work_items = list(under_test._work_items(versions, datetime(2019, 8, 7), task_cache))
+
+        assert len(work_items) == 3
+        assert work_items[0].version_next == versions[0]
+        assert work_items[0].version == versions[1]
+        assert work_items[0].version_prev == versions[2]
+        assert work_items[-1].version == versions[3]
+        assert all(item.task_cache is task_cache for item in work_items)
+
+    def test_no_versions_fetched_past_look_back(self):
+        versions = iter([MagicMock(create_time=datetime(2019, 8, 10 - i)) for i in range(6)])
+        task_cache = under_test.VersionTaskCache()
+
+        work_items = list(under_test._work_items(versions, datetime(2019, 8, 7), task_cache))
+
+        assert len(work_items) == 3
+        assert len(list(versions)) == 1
+
+    def test_too_few_versions(self):
+        versions = [MagicMock(create_time=datetime(2019, 8, 10 - i)) for i in range(2)]
+
+        task_cache = under_test.VersionTaskCache()
+
+        assert list(under_test._work_items(versions, datetime(2019, 8, 1), task_cache)) == []
+
+
+class TestFind:
+    def test_flip_found_in_version_that_introduced_it(self):
+        look_back = datetime(2019, 8, 1)
+        versions = [
+            build_mock_version("rev0", datetime(2019, 8, 5), {"t1": "failed", "t2": "success"}),
+            build_mock_version("rev1", datetime(2019, 8, 4), {"t1": "failed", "t2": "success"}),
+            build_mock_version("rev2", datetime(2019, 8, 3), {"t1": "success", "t2": "success"}),
+            build_mock_version("rev3", datetime(2019, 7, 30), {"t1": "success", "t2": "failed"}),
+            build_mock_version("rev4", datetime(2019, 7, 29), {"t1": "success", "t2": "failed"}),
+        ]
+        mock_evg_api = build_mock_evg_api()
+        mock_evg_api.versions_by_project.return_value = iter(versions)
+
+        flips = under_test.find("project", look_back, mock_evg_api, n_threads=2)
+
+        assert flips == {"rev1": {"!variant": ["t1"]}}
+        for mock_version in versions[:4]:
+            mock_version.get_builds.assert_called_once()
+            mock_version.build_by_variant.assert_not_called()
+
+    def test_auto_threads(self):
+        versions = [
+            build_mock_version("rev0", datetime(2019, 8, 5), {"t1": "failed"}),
+            build_mock_version("rev1", datetime(2019, 8, 4), {"t1": "failed"}),
+            build_mock_version("rev2", datetime(2019, 8, 3), {"t1": "success"}),
+        ]
+        mock_evg_api = build_mock_evg_api()
+        mock_evg_api.versions_by_project.return_value = iter(versions)
+
+        flips = under_test.find("project", datetime(2019, 8, 1), mock_evg_api, n_threads=None)
+
+        assert flips == {"rev1": {"!variant": ["t1"]}}
+        # The builds fetched to pick the number of threads are reused.
+        versions[0].get_builds.assert_called_once()
+
+    def test_completed_versions_are_reused_between_runs(self, tmp_path):
+        cache_file = str(tmp_path / "cache.db")
+        versions = [
+            build_mock_version(f"rev{i}", datetime(2019, 8, 5 - i), {"t1": "failed"})
+            for i in range(4)
+        ]
+        for mock_version in versions:
+            mock_version.is_completed.return_value = True
+        mock_evg_api = build_mock_evg_api()
+
+        for _ in range(2):
+            mock_evg_api.versions_by_project.return_value = iter(versions)
+            under_test.find("project", datetime(2019, 8, 3), mock_evg_api, cache_file=cache_file)
+
+        for mock_version in versions:
+            mock_version.get_builds.assert_called_once()
+
+    def test_prefetch_thread_stops_when_a_job_fails(self):
+        versions = [
+            build_mock_version(f"rev{i}", datetime(2019, 8, 30 - i), {"t1": "failed"})
+            for i in range(20)
+        ]
+        for mock_version in versions:
+            mock_builds = mock_version.get_builds.return_value
+            mock_version.get_builds.side_effect = (
+                lambda mock_builds=mock_builds: time.sleep(0.05) or mock_builds)
+        versions[1].get_builds.side_effect = [ValueError("Evergreen is down"),
+                                              versions[1].get_builds.return_value]
+        mock_evg_api = build_mock_evg_api()
+        mock_evg_api.versions_by_project.return_value = iter(versions)
+
+        with pytest.raises(ValueError):
+            under_test.find("project", datetime(2019, 8, 1), mock_evg_api, n_threads=1)
+        call_counts = [mock_version.get_builds.call_count for mock_version in versions]
 
-        mock_prev_task = MagicMock(status=mock_task.status)
-        tasks_prev = {mock_task.display_name: mock_prev_task}
+        assert_prefetch_thread_exits()
+        # No jobs are left running, they could use the store after it was closed.
+        assert [mock_version.get_builds.call_count for mock_version in versions] == call_counts
 
-        mock_next_task = MagicMock(status="success")
-        tasks_next = {mock_task.display_name: mock_next_task}
+    def test_no_versions(self):
+        mock_evg_api = build_mock_evg_api()
+        mock_evg_api.versions_by_project.return_value = iter([])
 
-        assert under_test._is_task_a_flip(mock_task, tasks_prev, tasks_next)
+        assert under_test.find("project", datetime(2019, 8, 1), mock_evg_api) == {}